@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 '''\
-usage: venv-update [-h] [virtualenv_dir] [requirements [requirements ...]]
+usage: venv-update [-h] [--gc] [virtualenv_dir] [requirements [requirements ...]]
 
 Update a (possibly non-existant) virtualenv directory using a requirements.txt listing
 When this script completes, the virtualenv should have the same packages as if it were
@@ -10,12 +10,22 @@ removed, then rebuilt.
 To set the index server, export a PIP_INDEX_SERVER variable.
     See also: http://pip.readthedocs.org/en/latest/user_guide.html#environment-variables
 
+To bound the size of the ~/.pip wheelhouse and download cache, export VENV_UPDATE_CACHE_SIZE (in MB).
+    Least-recently used files are then removed after each install; wheels needed by the
+    requirements are never removed.
+
+Fully-installed virtualenvs are kept in ~/.pip/venv-templates, and copied (by reflink, where the
+    filesystem supports it) instead of being rebuilt from scratch. To change how many are kept,
+    export VENV_UPDATE_TEMPLATES (default: %(DEFAULT_TEMPLATES)s, 0 disables them).
+
 positional arguments:
   virtualenv_dir  Destination virtualenv directory (default: virtualenv_run)
   requirements    Requirements files. (default: requirements.txt)
 
 optional arguments:
   -h, --help      show this help message and exit
+  --gc            Only shrink the pip caches (default size: %(DEFAULT_CACHE_SIZE)s MB), keeping wheels
+                  needed by the requirements and virtualenv_dir. Nothing is installed.
 
 Version control at: https://github.com/yelp/venv-update
 '''
@@ -32,10 +42,15 @@ BOOTSTRAP_VERSIONS = (
     'wheel==0.24.0',
 )
 
+# size limit (MB) for the pip caches, when running --gc without VENV_UPDATE_CACHE_SIZE
+DEFAULT_CACHE_SIZE = 1024
+# how many virtualenv templates to keep, without VENV_UPDATE_TEMPLATES
+DEFAULT_TEMPLATES = 5
+
 
 def parseargs(args):
     if set(args) & set(('-h', '--help')):
-        print(__doc__, end='')
+        print(__doc__ % globals(), end='')
         exit(0)
 
     args = list(args)
@@ -43,6 +58,9 @@ def parseargs(args):
     while '--stage2' in args:
         stage = 2
         args.remove('--stage2')
+    while '--gc' in args:
+        stage = 'gc'
+        args.remove('--gc')
 
     virtualenv_dir = None
     requirements = []
@@ -113,6 +131,48 @@ def req_is_absolute(requirement):
     return False
 
 
+# findlink directory -> (directory mtime, index); see wheelhouse_index
+_WHEELHOUSE_INDEXES = {}
+
+
+def wheelhouse_index(findlink):
+    """Index the supported wheels in a find-links directory: {name: {version: [link, ...]}}
+
+    Names are munged and lowercased as in faster_find_requirement.
+    The index is built once per run, and rebuilt only when the directory's mtime changes
+    (e.g. after `pip wheel` has added to it).
+    """
+    from os import listdir
+    from os.path import getmtime, join
+    try:
+        mtime = getmtime(findlink)
+    except OSError:
+        return {}
+
+    cached = _WHEELHOUSE_INDEXES.get(findlink)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    from pip.wheel import Wheel
+    from pip.index import Link
+    from pip.exceptions import InvalidWheelFilename
+    index = {}
+    for filename in listdir(findlink):
+        if not filename.endswith('.whl'):
+            continue
+        try:
+            wheel = Wheel(filename)
+        except InvalidWheelFilename:
+            continue
+        if not wheel.supported():
+            continue
+        versions = index.setdefault(wheel.name.replace('-', '_').lower(), {})
+        versions.setdefault(wheel.version, []).append(Link('file://' + join(findlink, filename)))
+
+    _WHEELHOUSE_INDEXES[findlink] = (mtime, index)
+    return index
+
+
 def faster_find_requirement(self, req, upgrade):
     """see faster_pip_packagefinder"""
     from pip.index import BestVersionAlreadyInstalled
@@ -127,22 +187,17 @@ def faster_find_requirement(self, req, upgrade):
                 return None
 
         # then try an optimistic search for a .whl file:
-        from os.path import join
-        from glob import glob
-        from pip.wheel import Wheel
-        from pip.index import Link
+        # this matches the name-munging done in pip.wheel:
+        reqname = req.name.replace('-', '_').lower()
         for findlink in self.find_links:
             if findlink.startswith('file://'):
                 findlink = findlink[7:]
             else:
                 continue
-            # this matches the name-munging done in pip.wheel:
-            reqname = req.name.replace('-', '_')
-            for link in glob(join(findlink, reqname + '-*.whl')):
-                link = Link('file://' + link)
-                wheel = Wheel(link.filename)
-                if wheel.version in req.req and wheel.supported():
-                    return link
+            versions = wheelhouse_index(findlink).get(reqname, {})
+            for version, links in versions.items():
+                if version in req.req:
+                    return links[0]
 
     # otherwise, do the full network search
     return self.unpatched['find_requirement'](self, req, upgrade)
@@ -200,8 +255,9 @@ def dist_to_req(dist):
     return result
 
 
-def pip_get_installed():
+def pip_get_installed(working_set=None):
     """Code extracted from the middle of the pip freeze command.
+    Pass a working_set snapshot to avoid rescanning site-packages.
     """
     if True:
         # pragma:no cover:pylint:disable=no-name-in-module,import-error
@@ -211,9 +267,12 @@ def pip_get_installed():
             # pip < 6.0
             from pip.util import dist_is_local
 
+    if working_set is None:
+        working_set = fresh_working_set()
+
     return tuple(
         dist_to_req(dist)
-        for dist in fresh_working_set()
+        for dist in working_set
         if dist_is_local(dist)
     )
 
@@ -289,28 +348,39 @@ def fresh_working_set():
     return WorkingSetPlusEditableInstalls()
 
 
-def trace_requirements(requirements):
+def trace_requirements(requirements, working_set=None):
     """given an iterable of pip InstallRequirements,
     return the set of required packages, given their transitive requirements.
+
+    Each distinct requirement is resolved once, and each distribution's dependencies are queued once,
+    so the cost follows the number of packages rather than the number of dependency edges.
     """
     from collections import deque
     from pip import logger
     from pip.req import InstallRequirement
     from pip._vendor import pkg_resources
 
-    working_set = fresh_working_set()
+    if working_set is None:
+        working_set = fresh_working_set()
 
     # breadth-first traversal:
     errors = False
     queue = deque(requirements)
     result = []
     seen_warnings = set()
+    seen_reqs = set()  # normalized requirement strings, e.g. 'foo[bar]>=1.0'
+    traced = set()  # project keys whose dependencies are already queued
     while queue:
         req = queue.popleft()
         if req.req is None:
             # a file:/// requirement
             continue
 
+        req_key = str(req.req)
+        if req_key in seen_reqs:
+            continue
+        seen_reqs.add(req_key)
+
         try:
             dist = working_set.find(req.req)
         except pkg_resources.VersionConflict as conflict:
@@ -325,11 +395,15 @@ def trace_requirements(requirements):
             errors = True
             continue
 
+        if dist.key in traced:
+            continue
+        traced.add(dist.key)
+
         result.append(dist_to_req(dist))
 
         for dist_req in sorted(dist.requires(), key=lambda req: req.key):
-            # there really shouldn't be any circular dependencies...
-            queue.append(InstallRequirement(dist_req, str(req)))
+            if str(dist_req) not in seen_reqs:
+                queue.append(InstallRequirement(dist_req, str(req)))
 
     if errors:
         exit(1)
@@ -347,7 +421,7 @@ def path_is_within(path, within):
     return not relpath(path, within).startswith('..')
 
 
-def validate_venv(venv_path, venv_args):
+def validate_venv(venv_path, venv_args, reqs=()):
     """Ensure we have a valid virtualenv."""
     import json
     from sys import executable, version
@@ -385,7 +459,8 @@ def validate_venv(venv_path, venv_args):
             # this avoids running virtualenv against its own container
             executable = previous_state.get('executable', executable)
 
-    run((executable, '-m', 'virtualenv', venv_path) + venv_args)
+    if not clone_venv_template(template_key(validation, reqs), venv_path):
+        run((executable, '-m', 'virtualenv', venv_path) + venv_args)
 
     if isdir(venv_path):
         with open(state_path, 'w') as state:
@@ -395,23 +470,316 @@ def validate_venv(venv_path, venv_args):
             )
 
 
-def do_install(reqs):
+def site_packages_entries(site_packages):
+    """The sys.path entries site.addsitedir would add for site_packages: the directory, then the
+    path lines of its .pth files. Returns None if any .pth file has an import line, as those
+    need to be run at activation time.
+    """
+    from os import listdir
+    from os.path import abspath, exists, join
+    entries = [site_packages]
+    try:
+        names = sorted(name for name in listdir(site_packages) if name.endswith('.pth'))
+    except OSError:
+        return entries
+    for name in names:
+        with open(join(site_packages, name)) as pth:
+            for line in pth:
+                if line.startswith('#'):
+                    continue
+                if line.startswith(('import ', 'import\t')):
+                    return None
+                entry = abspath(join(site_packages, line.rstrip()))
+                if line.strip() and exists(entry) and entry not in entries:
+                    entries.append(entry)
+    return entries
+
+
+def write_activation_snapshot(venv_path):
+    """Record the sys.path entries that activating this virtualenv adds, next to .venv-update.state.
+
+    These are what activate_this.py would add via site.addsitedir, resolved once here,
+    so that activation can be a plain list splice. If a .pth file needs code run (e.g. *-nspkg.pth),
+    no snapshot is written, and activation falls back to activate_this.py.
+    """
+    import json
+    import sys
+    from os import remove
+    from os.path import exists, join
+    version = '%s.%s' % sys.version_info[:2]
+    snapshot_path = join(venv_path, '.venv-update.activate')
+    entries = site_packages_entries(join(venv_path, 'lib', 'python' + version, 'site-packages'))
+    if entries is None:
+        if exists(snapshot_path):
+            remove(snapshot_path)
+        return
+
+    with open(join(venv_path, '.venv-update.state')) as state:
+        validation = json.load(state)['validation']
+    with open(snapshot_path, 'w') as snapshot:
+        json.dump(
+            dict(validation=validation, version=version, prefix=venv_path, sys_path=entries),
+            snapshot,
+        )
+
+
+def venv_templates():
+    """return the directory of virtualenv templates, and how many to keep (zero if disabled)"""
     from os import environ
+    return environ['HOME'] + '/.pip/venv-templates', int(environ.get('VENV_UPDATE_TEMPLATES', DEFAULT_TEMPLATES))
 
-    previously_installed = pip_get_installed()
-    required = pip_parse_requirements(reqs)
 
-    requirements_as_options = tuple(
-        '--requirement={0}'.format(requirement) for requirement in reqs
-    )
+def template_key(validation, reqs):
+    """Fingerprint a fully-installed virtualenv: its validation (less its path), and its requirements."""
+    import json
+    from hashlib import sha1
+    fingerprint = sha1(json.dumps(validation[:-1], sort_keys=True).encode('UTF-8'))
+    for reqfile in reqs:
+        try:
+            with open(reqfile, 'rb') as requirements:
+                fingerprint.update(requirements.read())
+        except IOError:
+            continue  # stage2 will report this
+    return fingerprint.hexdigest()
+
+
+def copy_tree(src, dst):
+    """Copy a directory tree, sharing file data via reflinks where the filesystem supports it."""
+    from subprocess import check_call, CalledProcessError
+    try:
+        check_call(('cp', '-a', '--reflink=auto', src, dst))
+    except (OSError, CalledProcessError):
+        # e.g. BSD cp
+        from shutil import copytree, rmtree
+        rmtree(dst, ignore_errors=True)
+        copytree(src, dst, symlinks=True)
+
+
+def relocate_venv(venv_path, old_path):
+    """Fix up a copied virtualenv's absolute paths: its bin/ scripts, and any symlinks."""
+    import os
+    from os.path import join
+    from shutil import copymode
+    old, new = old_path.encode('UTF-8'), venv_path.encode('UTF-8')
+
+    for dirpath, dirnames, filenames in os.walk(venv_path):
+        for name in dirnames + filenames:
+            path = join(dirpath, name)
+            if os.path.islink(path):
+                target = os.readlink(path)
+                if target.startswith(old_path):
+                    os.unlink(path)
+                    os.symlink(venv_path + target[len(old_path):], path)
+
+    bin_dir = join(venv_path, 'bin')
+    for name in os.listdir(bin_dir):
+        path = join(bin_dir, name)
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as script:
+            contents = script.read()
+        if old not in contents or b'\0' in contents:
+            continue
+        # write a new file, rather than change one that may share its data with the template
+        with open(path + '.relocate', 'wb') as script:
+            script.write(contents.replace(old, new))
+        copymode(path, path + '.relocate')
+        os.rename(path + '.relocate', path)
+
+
+def clone_venv_template(key, venv_path):
+    """Copy a cached, fully-installed virtualenv to venv_path, if we have one. Returns whether we did."""
+    import json
+    from os import unlink, utime
+    from os.path import exists, join
+    templates, keep = venv_templates()
+    template = join(templates, key)
+    if not keep or not exists(template):
+        return False
 
+    info('Copying virtualenv from template: %s' % template)
+    copy_tree(template, venv_path)
+    with open(join(template, '.venv-update.template')) as origin:
+        relocate_venv(venv_path, json.load(origin)['path'])
+    unlink(join(venv_path, '.venv-update.template'))
+    utime(template, None)  # mark it as recently used
+    return True
+
+
+def save_venv_template(venv_path, reqs):
+    """Keep a copy of this fully-installed virtualenv, to be cloned by later runs.
+
+    This is only a cache: failures are reported, but never fail the run (or invalidate the virtualenv).
+    """
+    import json
+    from os import getpid, listdir, makedirs, rename
+    from os.path import exists, getmtime, join
+    from shutil import Error as CopyError, rmtree
+    from subprocess import CalledProcessError
+    templates, keep = venv_templates()
+    if not keep:
+        return
+
+    with open(join(venv_path, '.venv-update.state')) as state:
+        validation = json.load(state)['validation']
+    template = join(templates, template_key(validation, reqs))
+    if exists(template):
+        return
+
+    # copy, then rename, so a template is never seen half-written
+    partial = '%s.%i.partial' % (template, getpid())
+    try:
+        if not exists(templates):
+            makedirs(templates)
+        copy_tree(venv_path, partial)
+        with open(join(partial, '.venv-update.template'), 'w') as origin:
+            json.dump(dict(path=venv_path), origin)
+        rename(partial, template)
+    except (OSError, IOError, CopyError, CalledProcessError) as error:
+        rmtree(partial, ignore_errors=True)
+        if not exists(template):  # otherwise, a concurrent run saved it first
+            info('Could not save virtualenv template %s: %s' % (template, error))
+        return
+
+    # forget the least-recently used templates
+    try:
+        saved = [join(templates, name) for name in listdir(templates) if not name.endswith('.partial')]
+        for stale in sorted(saved, key=getmtime, reverse=True)[keep:]:
+            rmtree(stale, ignore_errors=True)
+    except OSError as error:
+        info('Could not clean up virtualenv templates: %s' % error)
+
+
+def pip_cache_dirs():
+    """return the (download cache, wheelhouse) directories used by do_install"""
+    from os import environ
     # We put the cache in the directory that pip already uses.
     # This has better security characteristics than a machine-wide cache, and is a
     #   pattern people can use for open-source projects
     pipdir = environ['HOME'] + '/.pip'
     # We could combine these caches to one directory, but pip would search everything twice, going slower.
-    pip_download_cache = pipdir + '/cache'
-    pip_wheels = pipdir + '/wheelhouse'
+    return pipdir + '/cache', pipdir + '/wheelhouse'
+
+
+def cache_key(name, version):
+    """normalize a project name and version, as found in requirements, wheel names and *-info directories"""
+    import re
+    return re.sub(r'[-_.]+', '_', name).lower(), version
+
+
+def requirement_file_pins(requirement_files):
+    """Find the name==version pins in requirements files, without needing pip."""
+    import re
+    from os.path import dirname, join
+    pins = set()
+    for reqfile in requirement_files:
+        try:
+            lines = open(reqfile).read().splitlines()
+        except IOError:
+            continue
+        for line in lines:
+            line = line.split('#', 1)[0].strip()
+            if line.startswith(('-r', '--requirement')):
+                included = re.split(r'[=\s]', line, 1)[-1].strip()
+                pins |= requirement_file_pins((join(dirname(reqfile), included),))
+                continue
+            match = re.match(r'^([A-Za-z0-9][A-Za-z0-9._-]*)(\[.*\])?\s*==\s*([^\s,;]+)$', line)
+            if match:
+                pins.add(cache_key(match.group(1), match.group(3)))
+    return pins
+
+
+def venv_installed_pins(venv_path):
+    """Find the installed (name, version) pairs of a virtualenv, from its *.dist-info and *.egg-info directories."""
+    from glob import glob
+    from os.path import basename
+    pins = set()
+    for info_dir in glob(venv_path + '/lib/python*/site-packages/*-info'):
+        parts = basename(info_dir).rsplit('.', 1)[0].split('-')
+        if len(parts) >= 2:
+            pins.add(cache_key(parts[0], parts[1]))
+    return pins
+
+
+def cache_size_limit(default=None):
+    """The configured cache size limit, in bytes, or None if there is no limit."""
+    from os import environ
+    size = environ.get('VENV_UPDATE_CACHE_SIZE', default)
+    if size is None or size == '':
+        return None
+    return int(size) * 1024 * 1024
+
+
+def cache_gc(limit, pins):
+    """Remove least-recently used files from the pip caches, until they total at most `limit` bytes.
+
+    Wheels whose (name, version) is in `pins` are never removed.
+    """
+    from os import stat, unlink
+    from os.path import isfile, join
+    download_cache, wheelhouse = pip_cache_dirs()
+
+    # each entry: (last use, size, paths) -- files are removed together
+    entries = []
+    total = 0
+    for filename in listdir_or_empty(wheelhouse):
+        path = join(wheelhouse, filename)
+        if not isfile(path):
+            continue
+        filestat = stat(path)
+        total += filestat.st_size
+        parts = filename.split('-')
+        if filename.endswith('.whl') and len(parts) >= 2 and cache_key(parts[0], parts[1]) in pins:
+            continue
+        entries.append((max(filestat.st_atime, filestat.st_mtime), filestat.st_size, (path,)))
+
+    # the download cache stores each download next to a .content-type file
+    downloads = {}
+    for filename in listdir_or_empty(download_cache):
+        path = join(download_cache, filename)
+        if isfile(path):
+            key = filename[:-len('.content-type')] if filename.endswith('.content-type') else filename
+            downloads.setdefault(key, []).append(path)
+    for paths in downloads.values():
+        stats = [stat(path) for path in paths]
+        size = sum(filestat.st_size for filestat in stats)
+        total += size
+        entries.append((max(max(filestat.st_atime, filestat.st_mtime) for filestat in stats), size, tuple(paths)))
+
+    removed = removed_size = 0
+    for dummy_last_use, size, paths in sorted(entries):
+        if total <= limit:
+            break
+        for path in paths:
+            unlink(path)
+        total -= size
+        removed += 1
+        removed_size += size
+
+    megabyte = 1024 * 1024
+    info('Cache cleanup: removed %i files (%i MB), %i MB remaining.' % (removed, removed_size // megabyte, total // megabyte))
+
+
+def listdir_or_empty(directory):
+    from os import listdir
+    try:
+        return listdir(directory)
+    except OSError:
+        return []
+
+
+def do_install(reqs):
+    from os import environ
+
+    # one snapshot of the installed packages per phase: before and after installation
+    previously_installed = pip_get_installed(fresh_working_set())
+    required = pip_parse_requirements(reqs)
+
+    requirements_as_options = tuple(
+        '--requirement={0}'.format(requirement) for requirement in reqs
+    )
+
+    pip_download_cache, pip_wheels = pip_cache_dirs()
 
     environ.update(
         PIP_DOWNLOAD_CACHE=pip_download_cache,
@@ -441,7 +809,7 @@ def do_install(reqs):
     install_opts += ('--no-index',)  # only use the cache
     recently_installed += pip_install(install_opts + requirements_as_options)
 
-    required_with_deps = trace_requirements(required)
+    required_with_deps = trace_requirements(required, fresh_working_set())
 
     # TODO-TEST require A==1 then A==2
     extraneous = (
@@ -455,6 +823,16 @@ def do_install(reqs):
     if extraneous:
         pip(('uninstall', '--yes') + tuple(sorted(extraneous)))
 
+    # 4) Optionally, shrink the caches, keeping every wheel these requirements use.
+    limit = cache_size_limit()
+    if limit is not None:
+        pins = set(cache_key(*bootstrap.split('==')) for bootstrap in BOOTSTRAP_VERSIONS)
+        for req in required_with_deps:
+            for qualifier, version in getattr(req.req, 'specs', ()):
+                if qualifier == '==':
+                    pins.add(cache_key(req.name, version))
+        cache_gc(limit, pins)
+
 
 def wait_for_all_subprocesses():
     from os import wait
@@ -542,17 +920,22 @@ def stage2(venv_path, reqs):
     python = venv_python(venv_path)
     import sys
     assert sys.executable == python, "Executable not in venv: %s != %s" % (sys.executable, python)
-    return do_install(reqs)
+    do_install(reqs)
+    write_activation_snapshot(venv_path)
+    save_venv_template(venv_path, reqs)
 
 
 def venv_update(stage, venv_path, reqs, venv_args):
     from os.path import abspath
     venv_path = abspath(venv_path)
     if stage == 1:
-        validate_venv(venv_path, venv_args)
+        validate_venv(venv_path, venv_args, reqs)
         return stage1(venv_path, reqs)
     elif stage == 2:
         return stage2(venv_path, reqs)
+    elif stage == 'gc':
+        pins = requirement_file_pins(reqs) | venv_installed_pins(venv_path)
+        return cache_gc(cache_size_limit(DEFAULT_CACHE_SIZE), pins)
     else:
         raise AssertionError('impossible stage value: %r' % stage)
 
@@ -561,6 +944,9 @@ def main():
     from sys import argv, path
     del path[:1]  # we don't (want to) import anything from pwd or the script's directory
     stage, venv_path, reqs, venv_args = parseargs(argv[1:])
+    if stage == 'gc':
+        # cleaning the caches says nothing about the virtualenv's validity
+        return venv_update(stage, venv_path, reqs, venv_args)
 
     from subprocess import CalledProcessError
     try:
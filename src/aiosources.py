@@ -0,0 +1,82 @@
+import asyncio
+import functools
+import os
+import shutil
+import tempfile
+import time
+
+import sources
+import sourcestate
+
+# asyncio entry points over sources (python 3 only), so a long-lived service
+#   can drive many source updates concurrently from one event loop
+# the blocking network and disk work runs in the loop's default executor
+
+
+async def _in_executor(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args))
+
+
+async def resolve_latest(source, project_root, github_=None, latest_shas=None):
+    return await _in_executor(sources.resolve_latest, source, project_root, github_, latest_shas)
+
+
+async def fetch_archive(resolution, downloads_directory):
+    return await _in_executor(sources.fetch_archive, resolution, downloads_directory)
+
+
+async def install_sha(alias, archive, project_root, include=None, exclude=None):
+    return await _in_executor(sources.install_sha, alias, archive, project_root, include, exclude)
+
+
+async def update_many(aliases, sources_dict, project_root, state=None, concurrency=8):
+    """
+    Brings each alias in aliases up to date, at most concurrency at a time
+    Returns a sources.UpdateResult for each alias, in the same order
+    state is an optional sourcestate connection, only used from the event loop's thread
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    # a private downloads directory, so concurrent calls don't clean up each other's files
+    downloads_parent = os.path.dirname(sources.downloads_directory(project_root))
+    if not os.path.exists(downloads_parent):
+        os.makedirs(downloads_parent)
+    downloads_directory = tempfile.mkdtemp(prefix='downloads-', dir=downloads_parent)
+    # aliases sharing a repo share one lookup, and one download per sha (as futures, so concurrent aliases wait on them)
+    lookups = {}
+    fetches = {}
+
+    def shared(futures, key, start):
+        if key not in futures:
+            futures[key] = asyncio.ensure_future(start())
+        return futures[key]
+
+    async def update(alias):
+        source = sources_dict[alias]
+        async with semaphore:
+            latest_shas = {}
+            if sources.needs_latest_lookup(source):
+                key = sources.repo_key(source['repo'])
+                latest_shas[key] = await shared(lookups, key, lambda: _in_executor(sources.lookup_latest_sha, source['repo']))
+            resolution = await resolve_latest(source, project_root, None, latest_shas)
+            if state is not None:
+                sourcestate.record_checks(state, [{'alias': alias, 'installed_sha': resolution.installed_sha,
+                                                   'latest_sha': resolution.latest_sha, 'last_checked': time.time()}])
+            archive = installation = None
+            if resolution.update_required:
+                archive = await shared(fetches, (sources.repo_key(resolution.repo), resolution.latest_sha),
+                                       lambda: fetch_archive(resolution, downloads_directory))
+                installation = await install_sha(alias, archive, project_root, *sources.path_filters(source))
+                if state is not None:
+                    sourcestate.record_install(state, alias, installation.sha, archive.size, installation.duration)
+            return sources.UpdateResult(alias, resolution, archive, installation, None)
+
+    # let every alias finish (even if one fails) before the downloads directory is removed from under them
+    try:
+        results = await asyncio.gather(*[update(alias) for alias in aliases], return_exceptions=True)
+    finally:
+        shutil.rmtree(downloads_directory, ignore_errors=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
@@ -0,0 +1,107 @@
+import threading
+from collections import namedtuple
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Renders files while sources are still being extracted
+#   extraction submits each written path to a bounded queue (blocking when it is full, to bound memory)
+#   and worker threads render from it, so extraction I/O and rendering overlap
+
+# paths rendered for an alias, and (path, exception) for each that failed
+Rendered = namedtuple('Rendered', 'alias paths errors')
+
+
+class RenderPipeline(object):
+    """
+    render is called as render(alias, path) from the worker threads
+    on_complete, if given, is called as on_complete(result, rendered) once an alias has both
+    finished extracting (see finish) and had every submitted path rendered
+    (if it raises in a worker thread, the worker carries on, and close() re-raises the first such error)
+    """
+
+    def __init__(self, render, on_complete=None, workers=2, max_pending=64):
+        self._render = render
+        self._on_complete = on_complete or (lambda result, rendered: None)
+        self._queue = queue.Queue(max_pending)
+        self._lock = threading.Lock()
+        # per alias: paths submitted but not yet rendered, and what has been rendered so far
+        self._pending = {}
+        self._rendered = {}
+        # per alias, once extraction is finished: the result to pass on to on_complete
+        self._finished = {}
+        self.completed = {}
+        self._callback_errors = []
+        self._workers = [threading.Thread(target=self._work) for _ in range(workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, alias, path):
+        """
+        Queues path (from alias) for rendering, blocking while the queue is full
+        """
+        with self._lock:
+            self._pending[alias] = self._pending.get(alias, 0) + 1
+            self._rendered.setdefault(alias, Rendered(alias, [], []))
+        self._queue.put((alias, path))
+
+    def finish(self, alias, result=None):
+        """
+        Marks alias as fully extracted; it completes once its queued paths are rendered
+        """
+        with self._lock:
+            self._finished[alias] = result
+            self._rendered.setdefault(alias, Rendered(alias, [], []))
+            completed = self._take_if_drained(alias)
+        if completed:
+            self._on_complete(*completed)
+
+    def close(self):
+        """
+        Waits for everything submitted to be rendered, then stops the workers
+        Returns the Rendered results, by alias
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self._callback_errors:
+            raise self._callback_errors[0]
+        return self.completed
+
+    def _take_if_drained(self, alias):
+        # called with the lock held
+        if alias not in self._finished or self._pending.get(alias, 0):
+            return None
+        rendered = self._rendered.pop(alias)
+        self.completed[alias] = rendered
+        return self._finished.pop(alias), rendered
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            alias, path = item
+            try:
+                self._render(alias, path)
+                error = None
+            except Exception as exc:
+                error = exc
+            with self._lock:
+                rendered = self._rendered[alias]
+                if error is None:
+                    rendered.paths.append(path)
+                else:
+                    rendered.errors.append((path, error))
+                self._pending[alias] -= 1
+                completed = self._take_if_drained(alias)
+            if completed:
+                # a failing callback mustn't kill the worker, or submit() and close() would block forever
+                try:
+                    self._on_complete(*completed)
+                except Exception as exc:
+                    self._callback_errors.append(exc)
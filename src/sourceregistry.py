@@ -0,0 +1,94 @@
+import os
+import csv
+import time
+import shutil
+
+import yaml
+import yamltools
+import sources
+
+
+class SourceRegistry(object):
+    """
+    The custom sources file, held in memory while it is edited
+    Any number of edits are saved with a single backup and a single (atomic) write, via commit()
+    """
+
+    def __init__(self, file_path, backup_directory):
+        self.file_path = file_path
+        self.backup_directory = backup_directory
+        self.sources = sources.contents_to_alias_dict(sources.source_entries(yamltools.read_yaml_file(file_path)))
+        self.changed = False
+
+    def add(self, alias, repo, sha='latest', include=None, exclude=None):
+        """
+        Adds (or updates) the source with the given alias
+        include and exclude are its path filters (see sources.path_filters);
+        when not given, those of an existing source with the alias are kept
+        """
+        source = dict(self.sources.get(alias, {}))
+        source.update({'alias': alias, 'repo': repo, 'sha': sha or 'latest'})
+        for key, value in (('include', include), ('exclude', exclude)):
+            if value:
+                source[key] = value
+        self.sources[alias] = source
+        self.changed = True
+
+    def remove(self, alias):
+        """
+        Removes the source with the given alias, returns False if there isn't one
+        """
+        if alias not in self.sources:
+            return False
+        del self.sources[alias]
+        self.changed = True
+        return True
+
+    def clear(self):
+        self.sources = {}
+        self.changed = True
+
+    def backup(self):
+        """
+            make a quick copy of the custom sources file
+            in case the user wants it later
+        """
+        if not os.path.exists(self.file_path):
+            return None
+        timestr = time.strftime("%Y%m%d-%H%M%S")
+        backup_path = os.sep.join((self.backup_directory, 'custom-sources.backup.%s.yaml' % timestr))
+        shutil.copy(self.file_path, backup_path)
+        return backup_path
+
+    def commit(self):
+        """
+        Backs up the file, then writes all changes made since it was read
+        Returns False if there were no changes to write (including edits that left the file as it was)
+        """
+        if not self.changed:
+            return False
+        self.changed = False
+        return yamltools.write_yaml_file(list(self.sources.values()), self.file_path, lambda item: item['alias'],
+                                         before_write=self.backup)
+
+
+def read_source_list(stream):
+    """
+    Reads a list of sources (dicts of alias, repo and optionally sha, include and exclude) from a YAML or CSV stream
+    YAML may be a list of sources, or a list under a 'custom_sources' key (as in custom-sources.yaml)
+    CSV may have a header row naming its columns (an include or exclude column holds a single glob),
+    otherwise the columns are alias, repo, sha
+    """
+    text = stream.read()
+    try:
+        contents = yaml.safe_load(text)
+    except yaml.YAMLError:
+        contents = None
+    if isinstance(contents, (list, dict)):
+        return sources.source_entries(contents)
+    rows = [row for row in csv.reader(text.splitlines()) if row and row[0].strip()]
+    if rows and 'alias' in [column.strip().lower() for column in rows[0]]:
+        columns, rows = [column.strip().lower() for column in rows[0]], rows[1:]
+    else:
+        columns = ['alias', 'repo', 'sha']
+    return [dict(zip(columns, [value.strip() for value in row])) for row in rows]
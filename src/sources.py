@@ -0,0 +1,303 @@
+import os
+import time
+import shutil
+import fnmatch
+import zipfile
+from collections import namedtuple
+
+import requests
+from github import Github
+
+import yamltools
+import sourcestate
+import renderpipeline
+
+# The core of resolving, downloading and installing template sources
+#   everything here returns structured results rather than printing,
+#   so it can be driven from manage.py or imported by other tools (see aiosources for asyncio)
+
+DOMAIN_CONFIG_YAML = 'config.yaml'
+DOMAIN_CONFIG_VERSION = 'local-version.yaml'
+DOMAIN_FOLDER_FRAGMENT = 'domains'
+
+# alias, repo and sha (the version requirement) as configured
+# installed_sha is None if the source is not installed
+# latest_sha is the sha to install, or None if it could not be resolved (see message)
+Resolution = namedtuple('Resolution', 'alias repo sha installed_sha latest_sha download_url update_required message')
+Archive = namedtuple('Archive', 'repo sha path size')
+Installation = namedtuple('Installation', 'alias sha folder files duration')
+# the outcome of update_many for one alias; archive, installation and rendered are None if not needed
+UpdateResult = namedtuple('UpdateResult', 'alias resolution archive installation rendered')
+
+
+def source_entries(contents):
+    # custom-sources.yaml has been written both as a bare list, and under a 'custom_sources' key
+    if isinstance(contents, dict):
+        contents = contents.get('custom_sources')
+    return contents or []
+
+
+def contents_to_alias_dict(contents):
+    contents_dict = {}
+    for item in contents:
+        key = dict(item).get('alias', None)
+        if key:
+            contents_dict[key] = item
+    return contents_dict
+
+
+def combine_sources(custom_contents, default_contents):
+    """
+    Combines custom and default source lists into a single alias dict
+    (default sources take precedence)
+    """
+    sources_dict = contents_to_alias_dict(custom_contents)
+    sources_dict.update(contents_to_alias_dict(default_contents))
+    return sources_dict
+
+
+def domain_folder(project_root, alias):
+    return os.sep.join((project_root, DOMAIN_FOLDER_FRAGMENT, alias))
+
+
+def read_installed_version(project_root, alias):
+    """
+    The contents of domains/<alias>/local-version.yaml (sha, source, include, exclude), or {} if it is not installed
+    """
+    version_file_contents = yamltools.read_yaml_file(
+        os.sep.join((domain_folder(project_root, alias), DOMAIN_CONFIG_VERSION)))
+    if isinstance(version_file_contents, dict):
+        return version_file_contents
+    return {}
+
+
+def read_installed_sha(project_root, alias):
+    """
+    The sha recorded in domains/<alias>/local-version.yaml, or None if it is not installed
+    """
+    return read_installed_version(project_root, alias).get('sha', None)
+
+
+def path_filters(source):
+    """
+    The (include, exclude) glob lists configured for a source, each a (possibly empty) list
+    """
+    filters = []
+    for key in ('include', 'exclude'):
+        patterns = source.get(key) or []
+        if not isinstance(patterns, list):
+            patterns = [patterns]
+        filters.append([str(pattern).strip('/') for pattern in patterns])
+    return tuple(filters)
+
+
+def path_selected(path, include, exclude):
+    """
+    True if path (relative to the repo's top level) should be extracted:
+    it, or a directory it is in, matches an include glob (or there are none), and none match an exclude glob
+    """
+    parts = path.split('/')
+    candidates = ['/'.join(parts[:index]) for index in range(1, len(parts) + 1)]
+
+    def matches(patterns):
+        return any(fnmatch.fnmatchcase(candidate, pattern) for pattern in patterns for candidate in candidates)
+
+    if include and not matches(include):
+        return False
+    return not (exclude and matches(exclude))
+
+
+def github_address(repo):
+    return '/'.join(repo.split('/')[-2:])
+
+
+def repo_key(repo):
+    """
+    Identifies a github repo regardless of url format (git://, https://, trailing .git, case)
+    so aliases sharing a repo can share its lookups and downloads
+    """
+    address = github_address(repo).lower()
+    return address[:-len('.git')] if address.endswith('.git') else address
+
+
+def needs_latest_lookup(source):
+    """
+    True if source's version requirement is 'latest' on a github repo, so resolving it needs lookup_latest_sha
+    """
+    return 'github.com' in source['repo'].lower() and str(source['sha']).lower() == 'latest'
+
+
+def lookup_latest_sha(repo, github_=None):
+    """
+    The latest commit on the repo's default branch
+    """
+    github_ = github_ or Github()
+    github_repo = github_.get_repo(github_address(repo))
+    default_branch = github_repo.get_branch(github_repo.default_branch)
+    return default_branch.commit.sha
+
+
+def resolve_latest(source, project_root, github_=None, latest_shas=None):
+    """
+    Works out what version of source should be installed, and if that needs an update
+    A version requirement of 'latest' is resolved to the latest commit on the repo's default branch
+    latest_shas is an optional dict (by repo_key) shared between calls, so each repo is only looked up once
+    """
+    installed_version = read_installed_version(project_root, source['alias'])
+    installed_sha = installed_version.get('sha', None)
+    # a change to the path filters needs a reinstall too
+    filters_changed = path_filters(installed_version) != path_filters(source)
+
+    def resolution(latest_sha, message):
+        update_required = latest_sha is not None and (installed_sha != latest_sha or filters_changed)
+        download_url = None
+        if update_required:
+            download_url = "https://github.com/{github_address}/archive/{sha}.zip".format(
+                github_address=github_address(source['repo']), sha=latest_sha)
+        return Resolution(source['alias'], source['repo'], source['sha'], installed_sha, latest_sha,
+                          download_url, update_required, message)
+
+    # first, we check that the url in the config is a github one
+    #  (works for http:// and git:// formats this way)
+    if not 'github.com' in source['repo'].lower():
+        return resolution(None, "not a github repo url (currently, only github repo's are supported)")
+    if not needs_latest_lookup(source):
+        return resolution(source['sha'], "version requirement is %s" % source['sha'])
+    latest_shas = {} if latest_shas is None else latest_shas
+    key = repo_key(source['repo'])
+    if key not in latest_shas:
+        latest_shas[key] = lookup_latest_sha(source['repo'], github_)
+    return resolution(latest_shas[key], "latest commit is %s" % latest_shas[key])
+
+
+def fetch_archive(resolution, downloads_directory):
+    """
+    Downloads the archive for a resolution (that requires an update) into downloads_directory
+    """
+    if not os.path.exists(downloads_directory):
+        os.makedirs(downloads_directory)
+    save_file_name = '-'.join((github_address(resolution.repo).replace('/', '-'), resolution.latest_sha)) + '.zip'
+    save_file_location = os.path.sep.join((downloads_directory, save_file_name))
+    archive_contents = requests.get(resolution.download_url).content
+    with open(save_file_location, 'wb') as cache_file:
+        cache_file.write(archive_contents)
+    return Archive(resolution.repo, resolution.latest_sha, save_file_location, len(archive_contents))
+
+
+def install_sha(alias, archive, project_root, include=None, exclude=None, changed=None):
+    """
+    Replaces the contents of domains/<alias> with the contents of archive, and records its sha
+    include and exclude are optional lists of globs (see path_filters and path_selected);
+    entries are filtered using the zip's directory, so excluded files are never decompressed
+    changed, if given, is called with the path of each file as soon as it is written
+    """
+    start = time.time()
+    current_template_directory = domain_folder(project_root, alias)
+    # remove the contents of any existing template dir
+    if os.path.exists(current_template_directory):
+        shutil.rmtree(current_template_directory)
+    # create a new empty dir
+    os.makedirs(current_template_directory)
+    # github's archive format is a top level folder with the full name (inc sha sum)
+    #    we take the contents of that folder, and extract it into domains/[alias]/
+    #    (stripping whatever that folder is called, as aliases sharing an archive may spell the repo differently)
+    files = 0
+    with zipfile.ZipFile(archive.path, 'r') as current_zip:
+        for item in current_zip.namelist():
+            # skip over directories in the zip file
+            # TODO: binary file support - whitelist text filetypes or check encoding
+            if item[-1] == '\\' or item[-1] == '/':
+                continue
+            output_filename = item.replace('\\', '/').split('/', 1)[-1]
+            if not path_selected(output_filename, include, exclude):
+                continue
+            output_filepath = os.path.sep.join((current_template_directory, output_filename))
+            # make sure any required directory is present
+            if not os.path.exists(os.path.dirname(output_filepath)):
+                os.makedirs(os.path.dirname(output_filepath))
+            # write to the target file
+            with current_zip.open(item, 'r') as current_zip_file:
+                with open(output_filepath, 'wb') as target_file:
+                    target_file.write(current_zip_file.read())
+            files += 1
+            if changed:
+                changed(output_filepath)
+    local_version_info = {'source': archive.repo, 'sha': archive.sha}
+    if include:
+        local_version_info['include'] = include
+    if exclude:
+        local_version_info['exclude'] = exclude
+    yamltools.write_yaml_file(local_version_info, os.sep.join((current_template_directory, DOMAIN_CONFIG_VERSION)))
+    return Installation(alias, archive.sha, current_template_directory, files, time.time() - start)
+
+
+def downloads_directory(project_root):
+    return os.path.sep.join((project_root, '.tmp', 'downloads'))
+
+
+def update_many(aliases, sources_dict, project_root, state=None, progress=None, render=None, render_workers=2):
+    """
+    Brings each alias in aliases up to date, returning an UpdateResult for each
+    sources_dict maps aliases to their configuration (see combine_sources)
+    state is an optional sourcestate connection to record checks and installs in
+    progress, if given, is called with each Resolution, Archive and Installation as it happens
+    render, if given, is called as render(alias, path) for each extracted file, by render_workers
+      threads that run alongside extraction (see renderpipeline); an alias's Installation
+      (and then its Rendered result) is only passed to progress once its files are all rendered
+    """
+    progress = progress or (lambda result: None)
+    github_ = Github()
+    latest_shas = {}
+    resolutions = []
+    checks = []
+    for alias in aliases:
+        resolution = resolve_latest(sources_dict[alias], project_root, github_, latest_shas)
+        progress(resolution)
+        resolutions.append(resolution)
+        checks.append({'alias': alias, 'installed_sha': resolution.installed_sha,
+                       'latest_sha': resolution.latest_sha, 'last_checked': time.time()})
+    if state is not None:
+        sourcestate.record_checks(state, checks)
+
+    pipeline = None
+    if render is not None:
+        def report_rendered(installation, rendered):
+            progress(installation)
+            progress(rendered)
+        pipeline = renderpipeline.RenderPipeline(render, report_rendered, render_workers)
+
+    # each distinct (repo, sha) is downloaded once, and installed for every alias that shares it
+    archives = {}
+    installs = {}
+    try:
+        for resolution in resolutions:
+            if not resolution.update_required:
+                continue
+            alias = resolution.alias
+            archive_key = (repo_key(resolution.repo), resolution.latest_sha)
+            if archive_key not in archives:
+                archives[archive_key] = fetch_archive(resolution, downloads_directory(project_root))
+                progress(archives[archive_key])
+            archive = archives[archive_key]
+            include, exclude = path_filters(sources_dict[alias])
+            changed = None
+            if pipeline:
+                changed = lambda path, alias=alias: pipeline.submit(alias, path)
+            installation = install_sha(alias, archive, project_root, include, exclude, changed)
+            installs[alias] = (archive, installation)
+            if state is not None:
+                sourcestate.record_install(state, alias, installation.sha, archive.size, installation.duration)
+            if pipeline:
+                pipeline.finish(alias, installation)
+            else:
+                progress(installation)
+    finally:
+        rendered = pipeline.close() if pipeline else {}
+        # clean up - remove any downloaded files
+        if os.path.exists(downloads_directory(project_root)):
+            shutil.rmtree(downloads_directory(project_root))
+    results = []
+    for resolution in resolutions:
+        archive, installation = installs.get(resolution.alias, (None, None))
+        results.append(UpdateResult(resolution.alias, resolution, archive, installation, rendered.get(resolution.alias)))
+    return results
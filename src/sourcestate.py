@@ -0,0 +1,135 @@
+import os
+import sqlite3
+
+# An index of what each source is configured as, and what is installed,
+#   so listing sources needs no network, and only reads domains/<alias>/ to seed an alias it has no record of
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS configured (
+    origin TEXT NOT NULL,
+    alias TEXT NOT NULL,
+    repo TEXT,
+    sha TEXT,
+    PRIMARY KEY (origin, alias)
+);
+CREATE TABLE IF NOT EXISTS installed (
+    alias TEXT PRIMARY KEY,
+    installed_sha TEXT,
+    latest_sha TEXT,
+    last_checked REAL,
+    archive_size INTEGER,
+    install_duration REAL
+);
+CREATE TABLE IF NOT EXISTS config_files (
+    origin TEXT PRIMARY KEY,
+    mtime REAL
+);
+"""
+
+
+def connect(db_path):
+    """
+    Opens (creating if required) the state database at db_path
+    """
+    if not os.path.exists(os.path.dirname(db_path)):
+        os.makedirs(os.path.dirname(db_path))
+    connection = sqlite3.connect(db_path)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+def _mtime(file_path):
+    return os.path.getmtime(file_path) if os.path.exists(file_path) else None
+
+
+def configured_is_current(connection, origin, config_path):
+    """
+    True if the configured sources for origin were recorded from the current version of config_path
+    """
+    row = connection.execute('SELECT mtime FROM config_files WHERE origin = ?', (origin,)).fetchone()
+    return row is not None and row['mtime'] == _mtime(config_path)
+
+
+def replace_configured(connection, origin, config_path, sources):
+    """
+    Replaces the configured sources for origin (eg 'default' or 'custom') with sources,
+    a list of source dicts as read from config_path
+    """
+    with connection:
+        connection.execute('DELETE FROM configured WHERE origin = ?', (origin,))
+        connection.executemany(
+            'INSERT OR REPLACE INTO configured (origin, alias, repo, sha) VALUES (?, ?, ?, ?)',
+            [(origin, source['alias'], source.get('repo'), source.get('sha'))
+             for source in sources if source.get('alias')])
+        connection.execute('INSERT OR REPLACE INTO config_files (origin, mtime) VALUES (?, ?)',
+                           (origin, _mtime(config_path)))
+
+
+def record_checks(connection, checks):
+    """
+    Records the result of checking sources for updates, in a single transaction
+    checks is a list of dicts with alias, installed_sha, latest_sha and last_checked
+    """
+    with connection:
+        for check in checks:
+            connection.execute('INSERT OR IGNORE INTO installed (alias) VALUES (?)', (check['alias'],))
+            connection.execute(
+                'UPDATE installed SET installed_sha = ?, latest_sha = ?, last_checked = ? WHERE alias = ?',
+                (check.get('installed_sha'), check.get('latest_sha'), check['last_checked'], check['alias']))
+
+
+def unrecorded_aliases(connection):
+    """
+    Configured aliases that have no install record yet
+    """
+    return [row['alias'] for row in connection.execute(
+        'SELECT DISTINCT c.alias FROM configured c LEFT JOIN installed i ON i.alias = c.alias WHERE i.alias IS NULL')]
+
+
+def seed_installed(connection, installed):
+    """
+    Creates install records from (alias, installed_sha) pairs, eg as read from local-version.yaml files
+    installed_sha may be None, recording the alias as known to be not installed
+    """
+    with connection:
+        connection.executemany('INSERT OR IGNORE INTO installed (alias, installed_sha) VALUES (?, ?)', installed)
+
+
+def record_install(connection, alias, sha, archive_size, install_duration):
+    """
+    Records a completed install of sha for alias
+    """
+    with connection:
+        connection.execute('INSERT OR IGNORE INTO installed (alias) VALUES (?)', (alias,))
+        connection.execute(
+            'UPDATE installed SET installed_sha = ?, archive_size = ?, install_duration = ? WHERE alias = ?',
+            (sha, archive_size, install_duration, alias))
+
+
+def list_sources(connection, origin=None, pattern=None, status=None):
+    """
+    Lists configured sources along with their installed state, ordered by alias
+    origin limits the results to 'default' or 'custom' sources
+    pattern is a glob matched against the alias (eg 'render*')
+    status is one of 'installed', 'missing' or 'outdated'
+    """
+    query = ['SELECT c.origin, c.alias, c.repo, c.sha, i.installed_sha, i.latest_sha, i.last_checked,'
+             ' i.archive_size, i.install_duration'
+             ' FROM configured c LEFT JOIN installed i ON i.alias = c.alias WHERE 1']
+    params = []
+    if origin:
+        query.append('AND c.origin = ?')
+        params.append(origin)
+    if pattern:
+        query.append('AND c.alias GLOB ?')
+        params.append(pattern)
+    if status == 'installed':
+        query.append('AND i.installed_sha IS NOT NULL')
+    elif status == 'missing':
+        query.append('AND i.installed_sha IS NULL')
+    elif status == 'outdated':
+        query.append("AND i.installed_sha IS NOT NULL AND i.installed_sha != "
+                     "(CASE WHEN lower(c.sha) = 'latest' THEN coalesce(i.latest_sha, i.installed_sha) ELSE c.sha END)")
+    query.append('ORDER BY c.alias, c.origin')
+    return connection.execute(' '.join(query), params).fetchall()
@@ -1,9 +1,42 @@
-
 # work out folder paths, using the location of this file as a base
 import os
+import sys
+import json
 this_folder = os.path.dirname(os.path.abspath(__file__))
 project_root = os.sep.join(str(this_folder).split(os.sep)[:-1])
-venv_bin_path = os.sep.join((project_root, 'env', 'dev', 'bin'))
+venv_path = os.sep.join((project_root, 'env', 'dev'))
+venv_bin_path = os.sep.join((venv_path, 'bin'))
+
+
+def _read_json_file(file_path):
+    try:
+        with open(file_path) as json_file:
+            return json.load(json_file)
+    except (IOError, ValueError):
+        return None
+
+
+def _apply_activation_snapshot():
+    """
+        splice in the sys.path entries venv-update recorded for the virtualenv
+        returns False if there is no snapshot matching the current venv state
+        (and interpreter version), in which case activate_this.py is needed instead
+    """
+    snapshot = _read_json_file(os.sep.join((venv_path, '.venv-update.activate')))
+    state = _read_json_file(os.sep.join((venv_path, '.venv-update.state')))
+    if not snapshot or not state:
+        return False
+    if snapshot.get('validation') != state.get('validation') or snapshot.get('prefix') != venv_path:
+        return False
+    if snapshot.get('version') != '%s.%s' % sys.version_info[:2]:
+        return False
+    # the same changes activate_this.py makes
+    os.environ['PATH'] = os.pathsep.join((venv_bin_path, os.environ.get('PATH', '')))
+    os.environ['VIRTUAL_ENV'] = venv_path
+    sys.real_prefix = sys.prefix
+    sys.prefix = venv_path
+    sys.path[:0] = [entry for entry in snapshot['sys_path'] if entry not in sys.path]
+    return True
 
 
 def activate_virtualenv():
@@ -14,7 +47,9 @@ def activate_virtualenv():
               os.sep.join((project_root, 'bootstrap.sh')))
         assert os.path.exists(venv_bin_path), "No virtualenv found"
     # safe to assume we are working alongside a functional virtualenv now
-    # now we need to run its activation script
-    activate_this = os.sep.join((venv_bin_path, 'activate_this.py'))
-    execfile(activate_this, dict(__file__=activate_this))  # @UndefinedVariable
+    # use the snapshot venv-update left us if we can, otherwise run its activation script
+    if not _apply_activation_snapshot():
+        activate_this = os.sep.join((venv_bin_path, 'activate_this.py'))
+        with open(activate_this) as activate_file:
+            exec(compile(activate_file.read(), activate_this, 'exec'), dict(__file__=activate_this))
     print("Running from the virtual environment:\n  %s\n" % venv_bin_path)
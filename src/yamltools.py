@@ -1,7 +1,11 @@
 
 import os
+import hashlib
 import yaml
 
+# the C (libyaml) dumper is much faster, when pyYAML has been built with it
+_Dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
 # TODO: Convert all yaml file reads to this function (no dict state use)
 
 
@@ -23,16 +27,48 @@ def read_yaml_file(file_path):
                 return None
 
 
-def write_yaml_file(contents, file_path, sort_func=None):
+def dump_yaml(contents, sort_func=None):
+    """
+    Serializes contents (sorted via sort_func, if given) to yaml bytes, using the C dumper where available
+    """
+    if sort_func:
+        contents = sorted(contents, key=sort_func)
+    data = yaml.dump(contents, Dumper=_Dumper, default_flow_style=False)
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return data
+
+
+def _file_matches(file_path, data):
+    # cheap size check first, then compare hashes
+    if not os.path.exists(file_path) or os.path.getsize(file_path) != len(data):
+        return False
+    existing = hashlib.sha1()
+    with open(file_path, 'rb') as current_file:
+        for chunk in iter(lambda: current_file.read(65536), b''):
+            existing.update(chunk)
+    return existing.digest() == hashlib.sha1(data).digest()
+
+
+def write_yaml_file(contents, file_path, sort_func=None, before_write=None):
     """
-    Writes contents to the given file_path
+    Writes contents to the given file_path, atomically, unless the file already has exactly that content
+    (so its mtime only changes when its content does)
     Support for sorting via sort_func (takes 1 parameter, item, returns sorting key)
+    before_write, if given, is called (with no parameters) only when the file is about to be changed
+    Returns True if the file was written, False if it was already up to date
     """
     # if type(contents) is dict:
     #    contents = [contents]
-    with open(file_path, 'w') as yaml_output:
-        if sort_func:
-            yaml_output.write(yaml.safe_dump(
-                sorted(contents, key=sort_func), default_flow_style=False))
-        else:
-            yaml_output.write(yaml.safe_dump(contents, default_flow_style=False))
+    data = dump_yaml(contents, sort_func)
+    if _file_matches(file_path, data):
+        return False
+    if before_write:
+        before_write()
+    # write to a temporary file alongside, then rename over the target,
+    #   so readers never see a partially written file
+    temp_path = '%s.%s.tmp' % (file_path, os.getpid())
+    with open(temp_path, 'wb') as yaml_output:
+        yaml_output.write(data)
+    os.rename(temp_path, file_path)
+    return True